@@ -3,10 +3,11 @@ Webhook ZapSign  ➜  consulta Notion  ➜  envia WhatsApp via Z‑API
 Versão SINGLE FILE para rodar em Render, Railway ou local.
 """
 
-import re, hmac, hashlib, httpx
+import re, hmac, hashlib, asyncio, time, logging, httpx, orjson
+from contextlib import asynccontextmanager
 from typing import List, Optional
 
-from fastapi import FastAPI, Request, HTTPException, status
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, status
 from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 
@@ -17,6 +18,7 @@ class Settings(BaseSettings):
     NOTION_TOKEN: str
     NOTION_DB_ID: str
     NOTION_VERSION: str = "2022-06-28"
+    NOTION_FAST_SCAN: bool = True   # detecta "results" vazio sem decodificar o JSON
 
     # Z‑API (WhatsApp)
     ZAPI_INSTANCE_ID: str
@@ -25,13 +27,29 @@ class Settings(BaseSettings):
     # (Opcional) HMAC ZapSign
     ZAPSIGN_HMAC_SECRET: str | None = None
 
+    # Valida o payload completo com Pydantic (mais lento; só para depuração)
+    DEBUG: bool = False
+
     class Config:
         env_file = ".env"
 
 settings = Settings()
 
+# Só o logger deste módulo: o root fica sem handler para não expor as URLs
+# da Z‑API (com token) que o httpx registra em INFO.
+logger = logging.getLogger(__name__)
+if settings.DEBUG:
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.DEBUG)
+
+_NONDIGIT = re.compile(r"\D")
+_ZAPI_SEND_PATH = (f"/instances/{settings.ZAPI_INSTANCE_ID}"
+                   f"/token/{settings.ZAPI_TOKEN}/send-message")
+
 
 # ───────────────────── Modelos Pydantic ───────────────────────────
+# Documentam o payload da ZapSign; no caminho normal o webhook lê só os
+# campos necessários via orjson e só valida o modelo inteiro com DEBUG=1.
 class ResendAttempts(BaseModel):
     whatsapp: int
     email: int
@@ -65,62 +83,165 @@ class WebhookPayload(BaseModel):
     signer_who_signed: Signer
 
 
+# ───────────────────── Mensagens WhatsApp ────────────────────────
+RENEWAL_TMPL = (
+    "Olá {first}, parabéns pela escolha de continuar seus estudos. "
+    "Tenho certeza de que a continuação dessa jornada será incrível. "
+    "Já sabe, não é? Se precisar de algo, pode contar com a gente! Rumo à fluência!"
+)
+
+WELCOME_TMPL = (
+    "Welcome {first}! 🎉 Parabéns pela excelente decisão para {nome_filho}! "
+    "Tenho certeza de que será uma experiência incrível para vocês!\n\n"
+    "Sou Marcello, seu ponto de contato para tudo o que precisar da Escola Karol Elói Language Learning. "
+    "Estou aqui para garantir que sua filha tenha uma jornada fluida, produtiva e cheia de progresso.\n\n"
+    "Vi que o e‑mail cadastrado é {email}. Você deseja usá-lo para tudo ou prefere trocar? "
+    "Lembrando que será somente um e‑mail para todas as plataformas."
+)
+
+
 # ───────────────────── Utilidades ─────────────────────────────────
-async def notion_search_student(email: str, full_name: str) -> bool:
-    """True se o aluno já existe no banco Notion."""
-    hdr = {
-        "Authorization": f"Bearer {settings.NOTION_TOKEN}",
-        "Notion-Version": settings.NOTION_VERSION,
-        "Content-Type": "application/json",
-    }
-
-    async with httpx.AsyncClient(timeout=10) as cli:
-        # 1) busca por e‑mail exato
-        q1 = {"filter": {"property": "Email", "rich_text": {"equals": email}}}
-        r = await cli.post(
-            f"https://api.notion.com/v1/databases/{settings.NOTION_DB_ID}/query",
-            headers=hdr, json=q1
-        )
-        r.raise_for_status()
-        if r.json()["results"]:
+async def _notion_query(cli: httpx.AsyncClient, flt: dict) -> bool:
+    """True se o filtro retornar ao menos uma página no banco Notion."""
+    r = await cli.post(f"/databases/{settings.NOTION_DB_ID}/query",
+                       content=orjson.dumps({"filter": flt, "page_size": 1}))
+    r.raise_for_status()
+    body = r.content
+    if settings.NOTION_FAST_SCAN:
+        if b'"results":[]' in body:
+            return False
+        if b'"results":[{' in body:
             return True
+    return bool(orjson.loads(body)["results"])
+
+
+async def _any_hit(*coros) -> bool:
+    """Roda as consultas em paralelo; retorna no primeiro acerto e cancela o resto.
 
-        # 2) se não achar, busca por primeiro nome
-        first = full_name.split()[0]
-        q2 = {"filter": {"property": "Student Name",
-                         "rich_text": {"contains": first}}}
-        r = await cli.post(
-            f"https://api.notion.com/v1/databases/{settings.NOTION_DB_ID}/query",
-            headers=hdr, json=q2
+    Um erro numa consulta só é propagado se nenhuma outra encontrar o aluno.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    error = None
+    try:
+        for fut in asyncio.as_completed(tasks):
+            try:
+                if await fut:
+                    return True
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return False
+    finally:
+        for t in tasks:
+            if t.done():
+                if not t.cancelled():
+                    t.exception()    # marca como lida: evita "never retrieved"
+            else:
+                t.cancel()
+
+
+STUDENT_CACHE_TTL = 300      # segundos
+STUDENT_CACHE_MAX = 2048
+_student_cache: dict[tuple[str, str], tuple[bool, float]] = {}
+
+
+async def notion_search_student(cli: httpx.AsyncClient,
+                                email: str, full_name: str, first: str) -> bool:
+    """True se o aluno já existe no banco Notion (cache TTL para reenvios da ZapSign).
+
+    Espera os valores já normalizados pelo webhook: e‑mail em minúsculas,
+    nome sem espaços nas pontas e ``first`` = primeiro nome.
+    """
+    key = (email, full_name.lower())
+    now = time.monotonic()
+    hit = _student_cache.get(key)
+    if hit and now - hit[1] < STUDENT_CACHE_TTL:
+        return hit[0]
+
+    try:
+        found = await _any_hit(
+            # 1) busca por e‑mail exato
+            _notion_query(cli, {"property": "Email",
+                                "rich_text": {"equals": email}}),
+            # 2) busca por primeiro nome
+            _notion_query(cli, {"property": "Student Name",
+                                "rich_text": {"contains": first}}),
         )
-        r.raise_for_status()
-        return bool(r.json()["results"])
+    except httpx.HTTPStatusError:
+        _student_cache.pop(key, None)
+        raise
 
+    _student_cache.pop(key, None)
+    if len(_student_cache) >= STUDENT_CACHE_MAX:
+        _student_cache.pop(next(iter(_student_cache)))   # descarta o mais antigo
+    _student_cache[key] = (found, now)
+    return found
 
-async def send_whatsapp(phone: str, msg: str):
+
+async def send_whatsapp(cli: httpx.AsyncClient, phone: str, msg: str):
     """Dispara texto simples na Z‑API."""
-    phone_digits = re.sub(r"\D", "", phone)
-    url = (f"https://api.z-api.io/instances/{settings.ZAPI_INSTANCE_ID}"
-           f"/token/{settings.ZAPI_TOKEN}/send-message")
-    payload = {"phone": phone_digits, "message": msg}
+    payload = {"phone": _NONDIGIT.sub("", phone), "message": msg}
+
+    r = await cli.post(_ZAPI_SEND_PATH, content=orjson.dumps(payload))
+    r.raise_for_status()
+
 
-    async with httpx.AsyncClient(timeout=10) as cli:
-        r = await cli.post(url, json=payload)
-        r.raise_for_status()
+_HMAC_KEY = (settings.ZAPSIGN_HMAC_SECRET.encode()
+             if settings.ZAPSIGN_HMAC_SECRET else None)
+_HMAC_PROTO = hmac.new(_HMAC_KEY, b"", hashlib.sha256) if _HMAC_KEY else None
 
 
 def verify_signature(body: bytes, header: str | None) -> bool:
     """Valida HMAC‑SHA256 ZapSign (header X‑Hub‑Signature‑256)."""
-    if not settings.ZAPSIGN_HMAC_SECRET or not header:
+    if _HMAC_PROTO is None:
         return True
-    expected = hmac.new(
-        settings.ZAPSIGN_HMAC_SECRET.encode(), body, hashlib.sha256
-    ).hexdigest()
-    return hmac.compare_digest(expected, header)
+    if not header:
+        return False
+    try:
+        provided = bytes.fromhex(header.removeprefix("sha256="))
+    except ValueError:
+        return False
+    mac = _HMAC_PROTO.copy()
+    mac.update(body)
+    return hmac.compare_digest(mac.digest(), provided)
 
 
 # ───────────────────── FastAPI ────────────────────────────────────
-app = FastAPI()
+MAX_BODY_BYTES = 64 * 1024
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50,
+                           keepalive_expiry=60)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Abre um client HTTP/2 por API e reaproveita as conexões entre webhooks."""
+    app.state.notion = httpx.AsyncClient(
+        base_url="https://api.notion.com/v1",
+        headers={
+            "Authorization": f"Bearer {settings.NOTION_TOKEN}",
+            "Notion-Version": settings.NOTION_VERSION,
+            "Content-Type": "application/json",
+        },
+        timeout=10,
+        limits=HTTP_LIMITS,
+        http2=True,
+    )
+    app.state.zapi = httpx.AsyncClient(
+        base_url="https://api.z-api.io",
+        headers={"Content-Type": "application/json"},
+        timeout=10,
+        limits=HTTP_LIMITS,
+        http2=True,
+    )
+    try:
+        yield
+    finally:
+        await app.state.notion.aclose()
+        await app.state.zapi.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -129,58 +250,75 @@ async def root():
 
 
 @app.post("/webhook/zapsign", status_code=204)
-async def webhook(request: Request):
-    raw = await request.body()
+async def webhook(request: Request, bg: BackgroundTasks):
+    # 0️⃣ Rejeita antes de ler o corpo: sem assinatura ou grande demais
+    sig = request.headers.get("X-Hub-Signature-256")
+    if _HMAC_PROTO is not None and not sig:
+        raise HTTPException(status_code=401, detail="Missing signature")
+
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+    raw = bytearray()
+    async for chunk in request.stream():
+        raw += chunk
+        if len(raw) > MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+    raw = bytes(raw)
 
     # 1️⃣ HMAC (opcional, mas recomendado)
-    if not verify_signature(raw, request.headers.get("X-Hub-Signature-256")):
+    if not verify_signature(raw, sig):
         raise HTTPException(status_code=401, detail="Invalid signature")
 
-    # 2️⃣ DEBUG opcional: imprime o JSON recebido
-    print("[JSON recebido da ZapSign]")
-    print(raw.decode())
+    # 2️⃣ DEBUG opcional: registra o JSON recebido (só formata com DEBUG=1)
+    logger.debug("JSON recebido da ZapSign: %s", raw)
 
-    # 3️⃣ Validação do JSON
+    # 3️⃣ Leitura do JSON (só os campos usados)
     try:
-        data = WebhookPayload.model_validate_json(raw)
+        if settings.DEBUG:
+            WebhookPayload.model_validate_json(raw)
+        data = orjson.loads(raw)
+        doc_status = data["status"]
+        signer = data["signer_who_signed"]
+        full_name = signer["name"].strip()
+        if not full_name and doc_status == "signed":
+            raise ValueError("signer_who_signed.name vazio")
+        first = full_name.split(maxsplit=1)[0] if full_name else ""
+        email = signer["email"].lower()
+        country, number = signer["phone_country"], signer["phone_number"]
+        if not (isinstance(country, str) and isinstance(number, str)):
+            raise TypeError("phone_country e phone_number devem ser texto")
+        # MONTA TELEFONE no formato correto (E.164, sem símbolos)
+        phone = _NONDIGIT.sub("", country + number)  # resultado: 5511975578651
+        if not phone and doc_status == "signed":
+            raise ValueError("telefone do signatário vazio")
+        nome_filho = None
+        for a in data.get("answers") or ():    # mesmas regras do modelo Answer
+            variable, value = a["variable"], a["value"]
+            if not (isinstance(variable, str) and isinstance(value, str)):
+                raise TypeError("answers: 'variable' e 'value' devem ser texto")
+            if nome_filho is None and variable.lower() == "nome completo":
+                nome_filho = value
     except Exception as e:
-        print("[ERRO NA VALIDAÇÃO]:", e)
+        logger.warning("Erro na validação do JSON: %s", e)
         raise HTTPException(status_code=400, detail=f"Erro no JSON: {e}")
 
     # 4️⃣ Ignora se o documento ainda estiver "pending"
-    if data.status != "signed":
+    if doc_status != "signed":
         return
 
-    signer = data.signer_who_signed
-    full_name = signer.name.strip()
-    email = signer.email.lower()
-
-    # 5️⃣ MONTA TELEFONE no formato correto (E.164, sem símbolos)
-    raw_phone = f"{signer.phone_country}{signer.phone_number}"
-    phone = re.sub(r"\D", "", raw_phone)  # resultado: 5511975578651
-    first = full_name.split()[0]
-
-    # 6️⃣ Verifica se é aluno novo ou renovação
-    already = await notion_search_student(email, full_name)
+    # 5️⃣ Verifica se é aluno novo ou renovação
+    already = await notion_search_student(request.app.state.notion,
+                                          email, full_name, first)
 
     if already:
-        msg = (
-            f"Olá {first}, parabéns pela escolha de continuar seus estudos. "
-            "Tenho certeza de que a continuação dessa jornada será incrível. "
-            "Já sabe, não é? Se precisar de algo, pode contar com a gente! Rumo à fluência!"
-        )
+        msg = RENEWAL_TMPL.format(first=first)
     else:
-        answers = {a.variable.lower(): a.value for a in data.answers}
-        nome_filho = answers.get("nome completo", "sua filha")
-        msg = (
-            f"Welcome {first}! 🎉 Parabéns pela excelente decisão para {nome_filho}! "
-            "Tenho certeza de que será uma experiência incrível para vocês!\n\n"
-            "Sou Marcello, seu ponto de contato para tudo o que precisar da Escola Karol Elói Language Learning. "
-            "Estou aqui para garantir que sua filha tenha uma jornada fluida, produtiva e cheia de progresso.\n\n"
-            f"Vi que o e‑mail cadastrado é {email}. Você deseja usá-lo para tudo ou prefere trocar? "
-            "Lembrando que será somente um e‑mail para todas as plataformas."
-        )
+        msg = WELCOME_TMPL.format_map(
+            {"first": first, "nome_filho": nome_filho or "sua filha",
+             "email": email})
 
-    # 7️⃣ Envia WhatsApp via Z‑API
-    await send_whatsapp(phone, msg)
+    # 6️⃣ Envia WhatsApp via Z‑API depois de responder 204 à ZapSign
+    bg.add_task(send_whatsapp, request.app.state.zapi, phone, msg)
 